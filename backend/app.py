@@ -1,15 +1,36 @@
 from flask import Flask, jsonify, send_from_directory, request
 from flask_cors import CORS
+from flask_compress import Compress
+from werkzeug.utils import safe_join
 import os
+import atexit
 import subprocess
+import shutil
 import threading
+import queue
 import logging
-import time
 import json
+import orjson
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, but also no gunicorn, so the app runs as a single
+    # process there and the thread locks alone are enough
+    fcntl = None
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 from face_detector import FaceDetector
 
 app = Flask(__name__)
 CORS(app)
+# Hand file transfers to the front-end web server (e.g. Apache mod_xsendfile).
+# Only enable when one is in front; the dev server would send empty bodies.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Compress HLS playlists, which grow with every segment (-hls_list_size 0)
+app.config['COMPRESS_MIMETYPES'] = ['application/vnd.apple.mpegurl', 'application/x-mpegURL', 'text/plain']
+app.config['COMPRESS_MIN_SIZE'] = 256
+Compress(app)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -18,6 +39,12 @@ logger = logging.getLogger(__name__)
 UPLOADS_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
 STREAMS_DIR = os.path.join(os.path.dirname(__file__), 'streams')
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+FFMPEG_LOG_PATH = os.path.join(STREAMS_DIR, 'ffmpeg.log')
+FFMPEG_LOCK_PATH = os.path.join(STREAMS_DIR, 'ffmpeg.lock')
+FFMPEG_PID_PATH = os.path.join(STREAMS_DIR, 'ffmpeg.pid')
+FACE_DETECTION_LOCK_PATH = os.path.join(DATA_DIR, 'face_detection.lock')
+# Source mtime of the last conversion FFmpeg finished successfully
+HLS_STAMP_PATH = os.path.join(STREAMS_DIR, 'sample', '.src_mtime')
 VIDEO_FILENAME = 'office.mp4'  # Updated to match your video file
 
 os.makedirs(UPLOADS_DIR, exist_ok=True)
@@ -27,77 +54,434 @@ os.makedirs(DATA_DIR, exist_ok=True)
 # Initialize face detector
 face_detector = FaceDetector()
 
-def convert_to_hls():
-    video_path = os.path.join(UPLOADS_DIR, VIDEO_FILENAME)
-    stream_output_dir = os.path.join(STREAMS_DIR, 'sample')
-    os.makedirs(stream_output_dir, exist_ok=True)
-
-    m3u8_path = os.path.join(stream_output_dir, 'playlist.m3u8')
+# Set once the playlist is known to exist; cleared whenever segments are cleared
+playlist_ready = threading.Event()
 
-    # Log paths for debugging
-    logger.debug(f"Video path: {video_path}")
-    logger.debug(f"Stream output dir: {stream_output_dir}")
-    logger.debug(f"M3U8 path: {m3u8_path}")
+# Long-lived FFmpeg process shared by all /api/start_stream calls. The thread
+# lock covers this process; FFMPEG_LOCK_PATH and FFMPEG_PID_PATH extend that
+# to every server process (e.g. gunicorn workers)
+_ffmpeg_proc = None
+_ffmpeg_lock = threading.Lock()
 
-    # Clear old segments
-    for file in os.listdir(stream_output_dir):
-        os.remove(os.path.join(stream_output_dir, file))
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive flock on path, blocking until no other process holds it"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-    if not os.path.exists(video_path):
-        logger.error(f"Video file not found: {video_path}")
+def running_ffmpeg_pid():
+    """Return the pid of a live FFmpeg started by any server process, or None"""
+    # Single-process platforms track FFmpeg through _ffmpeg_proc alone (and
+    # os.kill(pid, 0) would terminate the process on Windows)
+    if fcntl is None:
+        return None
+    pid = read_stamp(FFMPEG_PID_PATH)
+    if not pid or not pid.isdigit():
         return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    try:
+        # Rule out a recycled pid, and an FFmpeg that exited but was not yet
+        # reaped by its parent (a zombie)
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            name, _, rest = f.read().partition(b'(')[2].rpartition(b')')
+        if name != b'ffmpeg' or rest.split()[0] == b'Z':
+            return None
+    except (OSError, IndexError):
+        pass
+    return int(pid)
 
-    # Simple, proven FFmpeg settings with better quality
-    ffmpeg_cmd = [
-        'ffmpeg',
-        '-i', video_path,
+def stop_ffmpeg():
+    if _ffmpeg_proc and _ffmpeg_proc.poll() is None:
+        # FFmpeg ends the playlists with #EXT-X-ENDLIST on SIGTERM too, so drop
+        # the stamp to make the next start redo the truncated output
+        for path in (HLS_STAMP_PATH, FFMPEG_PID_PATH):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        _ffmpeg_proc.terminate()
+
+def stamp_when_finished(proc, src_mtime):
+    """Record the converted source once FFmpeg exits cleanly, marking the output reusable"""
+    if proc.wait() == 0:
+        with open(HLS_STAMP_PATH, 'w') as f:
+            f.write(src_mtime)
+        logger.info("HLS conversion finished")
+    else:
+        logger.warning(f"FFmpeg exited with code {proc.returncode}, output will be regenerated")
+
+atexit.register(stop_ffmpeg)
+
+# Face detection jobs, consumed one at a time by a single worker thread
+work_q = queue.Queue()
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+def face_detection_worker():
+    """Run queued face detection jobs, skipping videos whose face data is already current"""
+    while True:
+        video_path, output_path, force = work_q.get()
+        try:
+            # Each server process has its own queue, so the file lock keeps two
+            # of them from writing the same output at once
+            with file_lock(FACE_DETECTION_LOCK_PATH):
+                # Checked under the lock since another process may have just finished this video
+                if not force and not face_detector.should_process_video(video_path, output_path, refresh=True):
+                    logger.info(f"Face data already up to date for: {video_path}")
+                    continue
+                face_detector.process_video(video_path, output_path)
+        except Exception as e:
+            logger.error(f"Face detection worker failed: {str(e)}")
+        finally:
+            work_q.task_done()
+
+def enqueue_face_detection(video_path, output_path, force=False):
+    global _worker_thread
+    # Started lazily so each server process (e.g. forked gunicorn workers) gets its own
+    with _worker_lock:
+        if _worker_thread is None or not _worker_thread.is_alive():
+            _worker_thread = threading.Thread(target=face_detection_worker, daemon=True)
+            _worker_thread.start()
+    work_q.put((video_path, output_path, force))
+
+# Error bodies for paths clients poll repeatedly, serialized once at import
+_RESP_NOT_READY = orjson.dumps({"error": "HLS stream not ready yet, please try again in a moment"})
+_RESP_FACE_MISSING = orjson.dumps({"error": "Face detection data not found"})
+_RESP_FILE_NOT_FOUND = orjson.dumps({"error": "File not found"})
+
+def json_response(body, status=200):
+    # A fresh Response each time since after_request hooks (CORS) modify its headers
+    return app.response_class(body, status=status, mimetype='application/json')
+
+# Serialized face data, reused until face_data.json changes on disk
+_face_cache = {'mtime': 0, 'body': None}
+
+# Encoder-specific FFmpeg flags, in order of preference
+VIDEO_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll', '-rc', 'cbr'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast'],
+    'h264_vaapi': ['-vaapi_device', '/dev/dri/renderD128', '-c:v', 'h264_vaapi'],
+    'libx264': [
         '-c:v', 'libx264',
-        '-c:a', 'aac',
-        '-b:v', '1200k',           # Increased from 800k for better quality
-        '-b:a', '192k',            # Increased from 128k for better audio
-        '-f', 'hls',
-        '-hls_time', '6',          # Keep 6-second segments as before
-        '-hls_list_size', '0',
-        '-hls_segment_filename', os.path.join(stream_output_dir, 'segment_%03d.ts'),
-        m3u8_path
-    ]
-
-    logger.debug(f"Starting FFmpeg: {' '.join(ffmpeg_cmd)}")
+        '-preset', 'ultrafast', '-tune', 'zerolatency',
+        # No scene-cut keyframes so segments stay even, slice threading across all cores
+        '-x264-params', 'scenecut=0:sliced-threads=1:threads=auto'
+    ],
+}
+
+# Filters needed to get decoded frames onto the encoder's device
+VIDEO_ENCODER_UPLOAD = {
+    'h264_vaapi': 'format=nv12,hwupload',
+}
+
+# Adaptive bitrate renditions as (height, video bitrate), highest first
+HLS_LADDER = [
+    (1080, '3M'),
+    (720, '1500k'),
+    (480, '600k'),
+]
+
+# Longest source keyframe interval, in seconds, that stream copy can still cut
+# into roughly 1-second segments; sources with longer GOPs are re-encoded
+MAX_REMUX_GOP = 1.5
+
+def detect_video_encoder():
+    """Pick the first hardware H.264 encoder that FFmpeg can actually open, else libx264"""
+    try:
+        encoders = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            capture_output=True, text=True, timeout=10
+        ).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not query FFmpeg encoders: {str(e)}")
+        return 'libx264'
+
+    for encoder in ('h264_nvenc', 'h264_qsv', 'h264_vaapi'):
+        if f" {encoder} " not in encoders:
+            continue
+        # Encoders are listed whenever FFmpeg was built with them, so make sure
+        # the hardware is really there by encoding a single blank frame
+        probe_cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'color=black:s=256x256',
+            '-frames:v', '1', *VIDEO_ENCODER_ARGS[encoder], '-f', 'null', '-'
+        ]
+        if encoder in VIDEO_ENCODER_UPLOAD:
+            probe_cmd[-3:-3] = ['-vf', VIDEO_ENCODER_UPLOAD[encoder]]
+        try:
+            if subprocess.run(probe_cmd, capture_output=True, timeout=10).returncode == 0:
+                return encoder
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return 'libx264'
+
+_VIDEO_ENCODER = detect_video_encoder()
+logger.info(f"Using video encoder: {_VIDEO_ENCODER}")
+
+def probe_stream(video_path, stream, field='codec_name'):
+    """Return a field of the first video ('v') or audio ('a') stream.
+
+    Returns '' when the file has no such stream and None when ffprobe itself failed.
+    """
     try:
-        process = subprocess.Popen(
-            ffmpeg_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', f'{stream}:0',
+             '-show_entries', f'stream={field}', '-of', 'csv=p=0', video_path],
+            capture_output=True, text=True, timeout=10
         )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"ffprobe failed for {video_path}: {str(e)}")
+        return None
+    if result.returncode != 0:
+        logger.warning(f"ffprobe failed for {video_path}: {result.stderr.strip()}")
+        return None
+    return result.stdout.strip()
 
-        def log_ffmpeg_output(proc):
-            while proc.poll() is None:
-                line = proc.stderr.readline()
-                if line:
-                    logger.debug(f"FFmpeg: {line.strip()}")
-            _, stderr = proc.communicate()
-            if proc.returncode != 0:
-                logger.error(f"FFmpeg failed with code {proc.returncode}: {stderr}")
-            else:
-                logger.info("FFmpeg completed successfully")
+def max_keyframe_interval(video_path, window=10):
+    """Return the longest gap in seconds between video keyframes in the first window seconds, or None if unknown"""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', f'%+{window}',
+             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path],
+            capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"ffprobe failed for {video_path}: {str(e)}")
+        return None
+    if result.returncode != 0:
+        return None
 
-        threading.Thread(target=log_ffmpeg_output, args=(process,), daemon=True).start()
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time != 'N/A':
+            keyframes.append(float(pts_time))
+    if not keyframes:
+        return None
+    if len(keyframes) == 1:
+        # The next keyframe is beyond the probed window
+        return float(window)
+    keyframes.sort()
+    return max(b - a for a, b in zip(keyframes, keyframes[1:]))
 
-        # Wait for playlist creation
-        for _ in range(60):
-            if os.path.exists(m3u8_path) and os.path.getsize(m3u8_path) > 0:
-                logger.info(f"Playlist created: {m3u8_path}")
-                return '/streams/sample/playlist.m3u8'
-            time.sleep(1)
-        logger.error("Timeout waiting for playlist creation")
+def ladder_rungs(video_path):
+    """Return the HLS_LADDER rungs at or below the source height, or None if it is unknown"""
+    height = probe_stream(video_path, 'v', 'height')
+    if not height or not height.isdigit():
         return None
-    except Exception as e:
-        logger.error(f"FFmpeg setup failed: {str(e)}")
+    return [r for r in HLS_LADDER if r[0] <= int(height)] or [(int(height), HLS_LADDER[-1][1])]
+
+def build_ladder_args(rungs, has_audio):
+    """Build FFmpeg args that decode once and encode every rung of the ladder"""
+    upload = VIDEO_ENCODER_UPLOAD.get(_VIDEO_ENCODER)
+    splits = ''.join(f'[v{i}]' for i in range(len(rungs)))
+    filters = [f'[0:v]split={len(rungs)}{splits}']
+    for i, (rung_height, _) in enumerate(rungs):
+        scale = f'scale=-2:{rung_height}' + (f',{upload}' if upload else '')
+        filters.append(f'[v{i}]{scale}[v{i}o]')
+
+    args = ['-filter_complex', ';'.join(filters)]
+    for i, (_, bitrate) in enumerate(rungs):
+        args += ['-map', f'[v{i}o]']
+        if has_audio:
+            args += ['-map', '0:a:0']
+        args += [f'-b:v:{i}', bitrate]
+
+    stream_map = [f'v:{i},a:{i}' if has_audio else f'v:{i}' for i in range(len(rungs))]
+    return args + ['-var_stream_map', ' '.join(stream_map)]
+
+def read_stamp(stamp_path):
+    try:
+        with open(stamp_path, 'r') as f:
+            return f.read().strip()
+    except OSError:
         return None
 
+def hls_output_complete(stream_output_dir):
+    """Check that the master playlist exists and the first rendition's playlist is closed"""
+    master_path = os.path.join(stream_output_dir, 'master.m3u8')
+    variant_path = os.path.join(stream_output_dir, 'playlist_0.m3u8')
+    try:
+        if os.path.getsize(master_path) == 0:
+            return False
+        # Only a sanity check on files left behind: FFmpeg also writes the end tag
+        # when it is terminated, so the stamp is what proves the encode finished
+        with open(variant_path, 'rb') as f:
+            return f.read().rstrip().endswith(b'#EXT-X-ENDLIST')
+    except OSError:
+        return False
+
+class PlaylistReadyHandler(FileSystemEventHandler):
+    """Signal an event once the HLS playlist exists and is non-empty"""
+    def __init__(self, m3u8_path, ready):
+        super().__init__()
+        self.m3u8_path = m3u8_path
+        self.ready = ready
+
+    def _check(self, event):
+        if event.is_directory or os.path.basename(event.src_path) != os.path.basename(self.m3u8_path):
+            return
+        try:
+            if os.path.getsize(self.m3u8_path) > 0:
+                self.ready.set()
+        except OSError:
+            pass
+
+    def on_created(self, event):
+        self._check(event)
+
+    def on_modified(self, event):
+        self._check(event)
+
+    def on_moved(self, event):
+        # FFmpeg writes <name>.m3u8.tmp and renames it into place
+        if not event.is_directory and os.path.basename(event.dest_path) == os.path.basename(self.m3u8_path):
+            self.ready.set()
+
+def convert_to_hls():
+    global _ffmpeg_proc
+    # Held for the whole conversion so concurrent requests, in this or any other
+    # server process, never start a second FFmpeg
+    with _ffmpeg_lock, file_lock(FFMPEG_LOCK_PATH):
+        if (_ffmpeg_proc and _ffmpeg_proc.poll() is None) or running_ffmpeg_pid():
+            logger.info("FFmpeg already running, reusing existing stream")
+            return '/streams/sample/master.m3u8'
+
+        video_path = os.path.join(UPLOADS_DIR, VIDEO_FILENAME)
+        stream_output_dir = os.path.join(STREAMS_DIR, 'sample')
+
+        m3u8_path = os.path.join(stream_output_dir, 'master.m3u8')
+
+        # Log paths for debugging
+        logger.debug(f"Video path: {video_path}")
+        logger.debug(f"Stream output dir: {stream_output_dir}")
+        logger.debug(f"M3U8 path: {m3u8_path}")
+
+        if not os.path.exists(video_path):
+            logger.error(f"Video file not found: {video_path}")
+            return None
+
+        # Reuse a finished conversion of the same source file
+        src_mtime = str(os.path.getmtime(video_path))
+        if read_stamp(HLS_STAMP_PATH) == src_mtime and hls_output_complete(stream_output_dir):
+            logger.info("Source unchanged, using existing HLS output")
+            playlist_ready.set()
+            return '/streams/sample/master.m3u8'
+
+        # Clear old segments
+        playlist_ready.clear()
+        shutil.rmtree(stream_output_dir, ignore_errors=True)
+        os.makedirs(stream_output_dir, exist_ok=True)
+
+        video_codec = probe_stream(video_path, 'v')
+        audio_codec = probe_stream(video_path, 'a')
+        has_audio = bool(audio_codec)
+        rungs = None
+        encode_args = [
+            *VIDEO_ENCODER_ARGS[_VIDEO_ENCODER],
+            '-threads', '0',           # Let FFmpeg use all cores
+            # Keyframe every second so every 1-second segment starts on one
+            '-g', '30', '-keyint_min', '30',
+            '-force_key_frames', 'expr:gte(t,n_forced*1)',
+            '-c:a', 'aac',
+            '-b:a', '192k',            # Increased from 128k for better audio
+        ]
+        remux = video_codec == 'h264' and audio_codec in ('aac', '')
+        if remux:
+            # Stream copy can only cut segments at the source's keyframes, so
+            # -hls_time 1 is met only when they are about a second apart
+            gop = max_keyframe_interval(video_path)
+            if gop is not None and gop > MAX_REMUX_GOP:
+                logger.info(f"Source keyframes are up to {gop:.1f} s apart, re-encoding for 1-second segments")
+                remux = False
+        if remux:
+            # Source is already HLS-compatible, just repackage it into fMP4 segments.
+            # Copying cannot rescale, so this yields a single rendition.
+            logger.info("Source is H.264/AAC, remuxing without re-encoding")
+            codec_args = [
+                '-map', '0:v:0',
+                *(['-map', '0:a:0'] if has_audio else []),
+                '-c:v', 'copy',
+                '-c:a', 'copy',
+                '-var_stream_map', 'v:0,a:0' if has_audio else 'v:0',
+            ]
+        else:
+            if video_codec is not None and audio_codec is not None:
+                rungs = ladder_rungs(video_path)
+            if rungs is None:
+                # Without probe results the audio and source height are unknown, so
+                # encode one rendition at source size and keep audio if there is any
+                logger.warning("Could not probe source streams, encoding a single rendition")
+                upload = VIDEO_ENCODER_UPLOAD.get(_VIDEO_ENCODER)
+                codec_args = [
+                    '-map', '0:v:0', '-map', '0:a:0?',
+                    *(['-vf', upload] if upload else []),
+                    *encode_args,
+                ]
+            else:
+                # One decode feeding every rendition of the bitrate ladder
+                codec_args = [*build_ladder_args(rungs, has_audio), *encode_args]
+
+        # FFmpeg leaves %v unexpanded in the init segment name for a single
+        # rendition, so name that one's files with its index directly
+        variant = '%v' if rungs and len(rungs) > 1 else '0'
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-i', video_path,
+            *codec_args,
+            '-f', 'hls',
+            '-hls_time', '1',          # Short segments so the first one is playable within ~1 s
+            '-hls_list_size', '0',
+            '-hls_segment_type', 'fmp4',
+            '-hls_flags', 'independent_segments+program_date_time',
+            '-hls_fmp4_init_filename', f'init_{variant}.mp4',
+            '-master_pl_name', 'master.m3u8',
+            '-hls_segment_filename', os.path.join(stream_output_dir, f'segment_{variant}_%03d.m4s'),
+            os.path.join(stream_output_dir, f'playlist_{variant}.m3u8')
+        ]
+
+        logger.debug(f"Starting FFmpeg: {' '.join(ffmpeg_cmd)}")
+        observer = Observer()
+        observer.schedule(PlaylistReadyHandler(m3u8_path, playlist_ready), stream_output_dir, recursive=False)
+        observer.start()
+        try:
+            # Let FFmpeg write its log straight to a file instead of pumping it through Python
+            with open(FFMPEG_LOG_PATH, 'ab', buffering=0) as ffmpeg_log:
+                _ffmpeg_proc = subprocess.Popen(
+                    ffmpeg_cmd,
+                    stdout=subprocess.DEVNULL,
+                    stderr=ffmpeg_log
+                )
+            with open(FFMPEG_PID_PATH, 'w') as f:
+                f.write(str(_ffmpeg_proc.pid))
+            threading.Thread(target=stamp_when_finished, args=(_ffmpeg_proc, src_mtime), daemon=True).start()
+
+            # Wait for playlist creation
+            if playlist_ready.wait(timeout=60):
+                logger.info(f"Playlist created: {m3u8_path}")
+                return '/streams/sample/master.m3u8'
+            logger.error("Timeout waiting for playlist creation")
+            return None
+        except Exception as e:
+            logger.error(f"FFmpeg setup failed: {str(e)}")
+            return None
+        finally:
+            observer.stop()
+            observer.join()
+
 def start_hls_conversion():
-    time.sleep(2)  # Wait for Flask to stabilize
     logger.info("Initiating HLS conversion")
     try:
         result = convert_to_hls()
@@ -147,22 +531,54 @@ def start_stream():
 
 @app.route('/api/get_video', methods=['GET'])
 def get_video():
-    hls_path = '/streams/sample/playlist.m3u8'
-    m3u8_full_path = os.path.join(STREAMS_DIR, 'sample', 'playlist.m3u8')
-    if os.path.exists(m3u8_full_path) and os.path.getsize(m3u8_full_path) > 0:
+    hls_path = '/streams/sample/master.m3u8'
+    m3u8_full_path = os.path.join(STREAMS_DIR, 'sample', 'master.m3u8')
+
+    def playlist_exists():
+        try:
+            return os.path.getsize(m3u8_full_path) > 0
+        except OSError:
+            return False
+
+    # The file is the source of truth: another server process may have started
+    # a re-encode that cleared it. The event only lets a conversion running in
+    # this process wake the request early, and is never set from here.
+    if playlist_exists() or (playlist_ready.wait(timeout=0.5) and playlist_exists()):
         return jsonify({"video_url": f"http://localhost:5000{hls_path}"})
     else:
         logger.warning("HLS stream not ready")
-        return jsonify({"error": "HLS stream not ready yet, please try again in a moment"}), 503
+        return json_response(_RESP_NOT_READY, 503)
 
 @app.route('/streams/sample/<path:filename>')
 def serve_stream(filename):
     logger.debug(f"Serving file: {filename}")
+    stream_dir = os.path.join(STREAMS_DIR, 'sample')
     try:
-        return send_from_directory(os.path.join(STREAMS_DIR, 'sample'), filename)
+        if filename.endswith('.m3u8'):
+            # Playlists are small text that grows while encoding. Build a regular
+            # response so Flask-Compress can gzip it; file responses skip compression.
+            playlist_path = safe_join(stream_dir, filename)
+            if playlist_path is None:
+                raise FileNotFoundError(filename)
+            with open(playlist_path, 'rb') as f:
+                response = app.response_class(f.read(), mimetype='application/vnd.apple.mpegurl')
+            response.cache_control.no_cache = True
+            return response
+
+        # Segments are already compressed. conditional=True answers Range
+        # requests with 206 Partial Content.
+        response = send_from_directory(
+            stream_dir, filename,
+            conditional=True, etag=True
+        )
+        response.headers['Accept-Ranges'] = 'bytes'
+        # A re-encode reuses the same segment names, so clients revalidate
+        # against the ETag (a cheap 304 while unchanged) instead of caching blindly
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
         logger.error(f"Error serving file {filename}: {str(e)}")
-        return jsonify({"error": "File not found"}), 404
+        return json_response(_RESP_FILE_NOT_FOUND, 404)
 
 @app.route('/api/process_video', methods=['POST'])
 def process_video():
@@ -172,6 +588,7 @@ def process_video():
     
     try:
         # Check if we already have face data for this video
+        invalid_data = False
         if os.path.exists(output_path):
             # Check if video is newer than face data
             if not face_detector.should_process_video(video_path, output_path):
@@ -186,16 +603,18 @@ def process_video():
                         })
                     else:
                         logger.warning("Existing face data is invalid, reprocessing")
+                        invalid_data = True
         
+        if not os.path.exists(video_path):
+            return jsonify({"status": "error", "message": f"Video file '{VIDEO_FILENAME}' not found"}), 404
+
         # Process video if no data exists or video is newer
-        success = face_detector.process_video(video_path, output_path)
-        if success:
-            return jsonify({
-                "status": "success", 
-                "message": "Video processed successfully",
-                "cached": False
-            })
-        return jsonify({"status": "error", "message": "Failed to process video"}), 500
+        enqueue_face_detection(video_path, output_path, force=invalid_data)
+        return jsonify({
+            "status": "success",
+            "message": "Video queued for processing",
+            "cached": False
+        }), 202
     except Exception as e:
         logger.error(f"Error processing video: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -203,16 +622,28 @@ def process_video():
 @app.route('/api/face_data', methods=['GET'])
 def get_face_data():
     data_path = os.path.join(DATA_DIR, 'face_data.json')
-    if not os.path.exists(data_path):
-        return jsonify({"error": "Face detection data not found"}), 404
-    
+    video_path = os.path.join(UPLOADS_DIR, VIDEO_FILENAME)
+    # Hide data that is about to be replaced so pollers wait for the new results
+    if (work_q.unfinished_tasks or face_detector.is_processing
+            or face_detector.should_process_video(video_path, data_path)):
+        return json_response(_RESP_FACE_MISSING, 404)
+    try:
+        st = os.stat(data_path)
+    except FileNotFoundError:
+        return json_response(_RESP_FACE_MISSING, 404)
+
     try:
-        with open(data_path, 'r') as f:
-            data = json.load(f)
+        if st.st_mtime_ns != _face_cache['mtime']:
+            with open(data_path, 'rb') as f:
+                raw_bytes = f.read()
+            # Parse only to validate; the file is already JSON so serve it as-is
+            data = orjson.loads(raw_bytes)
             if not data or 'face_detections' not in data:
                 return jsonify({"error": "Invalid face detection data format"}), 500
-            return jsonify(data)
-    except json.JSONDecodeError:
+            _face_cache['body'] = raw_bytes
+            _face_cache['mtime'] = st.st_mtime_ns
+        return json_response(_face_cache['body'])
+    except orjson.JSONDecodeError:
         return jsonify({"error": "Face detection data is incomplete"}), 500
     except Exception as e:
         logger.error(f"Error reading face data: {str(e)}")
@@ -0,0 +1,29 @@
+# Production server settings, picked up automatically by `gunicorn app:app`
+# when run from the backend directory
+import fcntl
+import multiprocessing
+import os
+import threading
+
+bind = '0.0.0.0:5000'
+workers = multiprocessing.cpu_count()
+# Threaded workers rather than gevent: the watchdog observer and FFmpeg
+# subprocess handling rely on real OS threads
+worker_class = 'gthread'
+threads = 8
+# The app is not preloaded: importing it creates the FaceDetector, which probes
+# CUDA/OpenCL, and device state set up in the master is unusable after fork
+
+def post_worker_init(worker):
+    """Start HLS conversion from exactly one worker, once it has loaded the app"""
+    from app import STREAMS_DIR, start_hls_conversion
+    lock_file = open(os.path.join(STREAMS_DIR, '.hls_owner.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return
+    # Held for the worker's lifetime; the OS drops the lock if the worker dies,
+    # so its replacement takes over
+    worker.hls_owner_lock = lock_file
+    threading.Thread(target=start_hls_conversion, daemon=True).start()
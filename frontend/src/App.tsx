@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { BrowserRouter as Router, Routes, Route, Link } from 'react-router-dom';
 import axios from 'axios';
 import VideoPlayer from './components/VideoPlayer';
@@ -32,8 +32,19 @@ const VideoAnalyzer: React.FC = () => {
   const [faceData, setFaceData] = useState<FaceData | null>(null);
   const [currentTime, setCurrentTime] = useState(0);
   const [processing, setProcessing] = useState(false);
+  const pollRef = useRef<ReturnType<typeof setInterval> | null>(null);
+
+  const stopPolling = () => {
+    if (pollRef.current) {
+      clearInterval(pollRef.current);
+      pollRef.current = null;
+    }
+  };
+
+  useEffect(() => stopPolling, []);
 
   const handleLoadVideo = async () => {
+    stopPolling();
     setFaceData(null);
     setProcessing(false);
     setLoading(true);
@@ -62,7 +73,18 @@ const VideoAnalyzer: React.FC = () => {
         }
       }
 
-      const pollInterval = setInterval(async () => {
+      // Detection runs in the background and its run time scales with the
+      // video, so poll until the data arrives (404 means not ready yet) or a
+      // real error comes back, giving up only after several times the video length
+      const pollStart = Date.now();
+      pollRef.current = setInterval(async () => {
+        const duration = document.querySelector('video')?.duration ?? NaN;
+        if (Number.isFinite(duration) && Date.now() - pollStart > Math.max(60, duration * 4) * 1000) {
+          setError('Face detection timed out');
+          setProcessing(false);
+          stopPolling();
+          return;
+        }
         try {
           const faceRes = await axios.get('http://localhost:5000/api/face_data');
           if (faceRes.data?.face_detections) {
@@ -71,25 +93,17 @@ const VideoAnalyzer: React.FC = () => {
               metadata: faceRes.data.metadata || { total_frames: 0, fps: 30 }
             });
             setProcessing(false);
-            clearInterval(pollInterval);
+            stopPolling();
           }
         } catch (err: any) {
           if (err.response?.status !== 404) {
             setError('Failed to load face detection data');
             setProcessing(false);
-            clearInterval(pollInterval);
+            stopPolling();
           }
         }
       }, 1000);
 
-      setTimeout(() => {
-        clearInterval(pollInterval);
-        if (processing) {
-          setError('Face detection timed out');
-          setProcessing(false);
-        }
-      }, 30000);
-
     } catch (e: any) {
       setError(e.message || 'Failed to load video');
       setLoading(false);